@@ -1,33 +1,154 @@
-import csv
-import io
-import json
 import logging
+import math
+import numpy as np
+import orjson
 import os
+import pandas
+import shutil
+import tempfile
 import yaml
 import zipfile
 
-from shapely.geometry import Point, LineString
-from shapely.ops import nearest_points
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit
+from shapely.geometry import LineString, box
+from shapely.strtree import STRtree
 
 from pyproj import Geod
 
+# mean earth radius in meters, used for distance approximations
+EARTH_RADIUS = 6371008.8
+
+# conservative lower bound of meters per degree, used to convert metric tolerances into degrees
+METERS_PER_DEGREE = 110000.0
+
+# minimum number of trip pattern groups per worker process, smaller feeds are matched in-process
+MINIMUM_GROUPS_PER_WORKER = 64
+
+def _tolerance_degrees(latitude, tolerance):
+    # latitude degrees are nearly constant in length, longitude degrees shrink with the latitude
+    tolerance_lat = tolerance / METERS_PER_DEGREE
+    tolerance_lon = tolerance / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+
+    return tolerance_lon, tolerance_lat
+
+def _tolerance_box(point, tolerance_lon, tolerance_lat):
+    return box(point[0] - tolerance_lon, point[1] - tolerance_lat, point[0] + tolerance_lon, point[1] + tolerance_lat)
+
+def _haversine_distance(coordinates_a, coordinates_b):
+    # great circle distance in meters between (lon, lat) coordinates, works on arrays as well
+    lon_a, lat_a = np.radians(coordinates_a).T
+    lon_b, lat_b = np.radians(coordinates_b).T
+
+    h = np.sin((lat_b - lat_a) / 2.0) ** 2 + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2.0) ** 2
+
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
+
+@njit(cache=True)
+def _match_line_string(line_string_coordinates, line_string_distances, pattern_coordinates, pattern_scales, tolerance):
+    # check whether all pattern points are within tolerance of the linestring and project them onto it
+    # this is a directed hausdorff test from the stops to the linestring, symmetric hausdorff or frechet
+    # distances would also measure the linestring against straight lines between stops and reject curved shapes
+    scale_y = math.radians(1.0) * EARTH_RADIUS
+    tolerance_squared = tolerance * tolerance
+    projections = np.empty(pattern_coordinates.shape[0], dtype=np.float64)
+
+    previous_segment = 0
+    previous_t = 0.0
+    for i in range(pattern_coordinates.shape[0]):
+        lon = pattern_coordinates[i, 0]
+        lat = pattern_coordinates[i, 1]
+
+        # project segments into a local metric plane around the point, which is accurate enough for small tolerances
+        scale_x = pattern_scales[i]
+
+        # search forward from the previous projection, this ensures the stops order matches the shape
+        # and shapes passing a stop twice like ring lines project each visit correctly
+        matched = False
+        for j in range(previous_segment, line_string_coordinates.shape[0] - 1):
+            start_x = (line_string_coordinates[j, 0] - lon) * scale_x
+            start_y = (line_string_coordinates[j, 1] - lat) * scale_y
+            delta_x = (line_string_coordinates[j + 1, 0] - lon) * scale_x - start_x
+            delta_y = (line_string_coordinates[j + 1, 1] - lat) * scale_y - start_y
+
+            # find the closest point on the segment by clamping the orthogonal projection, not before the previous projection
+            minimum_t = previous_t if j == previous_segment else 0.0
+            length_squared = delta_x * delta_x + delta_y * delta_y
+
+            t = minimum_t
+            if length_squared > 0.0:
+                t = min(max(-(start_x * delta_x + start_y * delta_y) / length_squared, minimum_t), 1.0)
+
+            # take the first segment within tolerance
+            closest_x = start_x + t * delta_x
+            closest_y = start_y + t * delta_y
+
+            if closest_x * closest_x + closest_y * closest_y <= tolerance_squared:
+                projections[i] = line_string_distances[j] + t * (line_string_distances[j + 1] - line_string_distances[j])
+
+                previous_segment = j
+                previous_t = t
+                matched = True
+                break
+
+        if not matched:
+            return False, projections
+
+    return True, projections
+
+def _list_gtfs_files(gtfs_input):
+    if gtfs_input.lower().endswith('.zip'):
+        with zipfile.ZipFile(gtfs_input) as gtfs_input_archive:
+            return [n for n in gtfs_input_archive.namelist() if n.endswith('.txt')]
+    else:
+        return [n for n in os.listdir(gtfs_input) if n.endswith('.txt')]
+
+def _open_gtfs_file(gtfs_input, gtfs_filename):
+    # open files directly inside the archive, the member keeps the archive open until it is closed itself
+    if gtfs_input.lower().endswith('.zip'):
+        with zipfile.ZipFile(gtfs_input) as gtfs_input_archive:
+            return gtfs_input_archive.open(gtfs_filename)
+    else:
+        return open(os.path.join(gtfs_input, gtfs_filename), 'rb')
+
+# matcher instance shared with worker processes for matching trip patterns
+_worker_matcher = None
+
+def _init_worker(matcher):
+    global _worker_matcher
+    _worker_matcher = matcher
+
+def _match_trip_pattern_group(trip_pattern_ids):
+    return _worker_matcher._match_trip_pattern_group(trip_pattern_ids)
+
 class GeojsonMatcher:
 
     def __init__(self, geojson_input, config_filename):
 
         self._geod = Geod(ellps='WGS84')
 
+        # load config file, empty files and missing sections are treated as empty config
+        self._config = dict()
         if config_filename is not None:
             with open(config_filename, 'r') as config_file:
-                self._config = yaml.safe_load(config_file)
-        else:
-            self._config = dict()
+                self._config = yaml.safe_load(config_file) or dict()
 
+        if self._config.get('config') is None:
             self._config['config'] = dict()
-            self._config['config']['maximum_matching_distance'] = 20
+
+        self._config['config'].setdefault('maximum_matching_distance', 20)
+
+        self._maximum_matching_distance = float(self._config['config']['maximum_matching_distance'])
 
         # generate empty containers
         self._geojson_linestrings = list()
+        self._geojson_coordinates = list()
+        self._geojson_lengths = list()
+        self._geojson_distances = list()
+
+        self._gtfs_stop_indices = dict()
+        self._gtfs_stop_coordinates = np.empty((0, 2), dtype=np.float64)
 
         self._gtfs_trip_patterns = dict()
         self._gtfs_trip_patterns_trip_ids = dict()
@@ -39,124 +160,207 @@ class GeojsonMatcher:
         if geojson_input.lower().endswith('.zip'):
             with zipfile.ZipFile(geojson_input) as geojson_zip_file:
                 for geojson_filename in geojson_zip_file.namelist():
-                    with io.TextIOWrapper(geojson_zip_file.open(geojson_filename), encoding='utf-8') as geojson_file:
+                    with geojson_zip_file.open(geojson_filename) as geojson_file:
                         self._read_geojson_file(geojson_file)
         else:
             for geojson_filename in os.listdir(geojson_input):
                 if geojson_filename.lower().endswith('.geojson'):
-                    with open(os.path.join(geojson_input, geojson_filename), 'r', encoding='utf-8') as geojson_file:
+                    with open(os.path.join(geojson_input, geojson_filename), 'rb') as geojson_file:
                         self._read_geojson_file(geojson_file)
 
-    def run(self, gtfs_input, gtfs_output):
-        
-        # determine working directory and copy input data or exract input archive
-        working_directory = gtfs_output
-        if gtfs_output.lower().endswith('.zip'):
-            working_directory = os.path.dirname(gtfs_output)
+        # build spatial index over all linestrings for pruning candidates
+        self._geojson_index = STRtree(self._geojson_linestrings)
 
-        if gtfs_input.lower().endswith('.zip'):
-            with zipfile.ZipFile(gtfs_input, 'r') as gtfs_input_archive:
-                gtfs_input_archive.extractall(working_directory)
-        else:
-            pass
+        # cache first and last coordinates of all linestrings for filtering start and end points
+        self._geojson_start_coordinates = np.array([c[0] for c in self._geojson_coordinates], dtype=np.float64).reshape(-1, 2)
+        self._geojson_end_coordinates = np.array([c[-1] for c in self._geojson_coordinates], dtype=np.float64).reshape(-1, 2)
+
+    def run(self, gtfs_input, gtfs_output):
         
         # read trip patterns of input GTFS feed into working index
-        self._read_gtfs_index(working_directory)
+        self._read_gtfs_index(gtfs_input)
 
-        # iterate over each trip pattern and find best matching shape
-        for trip_pattern_id, trip_pattern_coordinates in self._gtfs_trip_patterns.items():
-            start_point = trip_pattern_coordinates[0]
-            end_point = trip_pattern_coordinates[-1]
+        # group trip patterns by their start and end stop, they share the same linestring candidates
+        trip_pattern_groups = defaultdict(list)
+        for trip_pattern_id, trip_pattern_stop_indices in self._gtfs_trip_patterns.items():
+            trip_pattern_groups[(trip_pattern_stop_indices[0], trip_pattern_stop_indices[-1])].append(trip_pattern_id)
 
-            line_string_candidates = dict()
-            for index, line_string in enumerate(self._geojson_linestrings):
-                # check for the start and end point of the trip matches the linestring start and end
-                if self._geod.geometry_length(LineString(nearest_points(Point(line_string.coords[0]), start_point))) > 20:
-                    continue
+        # match all trip pattern groups, use worker processes only if each of them gets enough work
+        line_string_indices = dict()
 
-                if self._geod.geometry_length(LineString(nearest_points(Point(line_string.coords[-1]), end_point))) > 20:
-                    continue
-
-                # check whether any point in trip pattern is not in this linestring
-                line_string_matched = True
-                
-                trip_pattern_projections = list()
-                for tpc in trip_pattern_coordinates:
-                    if self._geod.geometry_length(LineString(nearest_points(line_string, tpc))) > 20:
-                        line_string_matched = False
-                        break
-
-                    trip_pattern_projections.append(line_string.project(tpc))
-
-                # check whether projections are increasing, this ensures the stops order matches the shape
-                line_projection_matched = True #trip_pattern_projections == sorted(trip_pattern_projections)
-
-                # if everything seems okay, use this as candidate
-                if line_string_matched and line_projection_matched:
-                    line_string_candidates[index] = self._geod.geometry_length(line_string)
-            
-            if len(line_string_candidates) > 0:
-                # determine linestring index with the shortest possible length, this must be our linestring!
-                line_string_index = min(line_string_candidates, key = line_string_candidates.get)
+        workers = min(os.cpu_count() or 1, len(trip_pattern_groups) // MINIMUM_GROUPS_PER_WORKER)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self,)) as executor:
+                for trip_pattern_matches in executor.map(_match_trip_pattern_group, trip_pattern_groups.values(), chunksize=16):
+                    line_string_indices.update(trip_pattern_matches)
+        else:
+            for trip_pattern_ids in trip_pattern_groups.values():
+                line_string_indices.update(self._match_trip_pattern_group(trip_pattern_ids))
 
+        # create shapes in the original trip pattern order to assign shape IDs deterministically
+        for trip_pattern_id in self._gtfs_trip_patterns.keys():
+            line_string_index = line_string_indices[trip_pattern_id]
+            if line_string_index is not None:
                 # render shape data and store shape ID for trip pattern
-                shape_id = self._create_shape(trip_pattern_id, self._geojson_linestrings[line_string_index])
+                shape_id = self._create_shape(trip_pattern_id, self._geojson_coordinates[line_string_index])
 
                 for trip_id in self._gtfs_trip_patterns_trip_ids[trip_pattern_id]:
                     self._gtfs_trips_shape_ids[trip_id] = shape_id
             else:
-                logging.warning(f"no matching line string found for trip pattern {trip_pattern_id}")
+                logging.warning(f"no matching line string found for trip pattern {'#'.join(trip_pattern_id)}")
 
                 affected_trip_ids = '\n'.join(self._gtfs_trip_patterns_trip_ids[trip_pattern_id])
                 logging.info(f"this has impacts on the following trip IDs:\n{affected_trip_ids}")
 
         # generate shape data output
-        self._write_gtfs_data(working_directory, gtfs_output)
+        self._write_gtfs_data(gtfs_input, gtfs_output)
+
+    def _match_trip_pattern_group(self, trip_pattern_ids):
+        # all trip patterns of a group start and end at the same stops, so candidates are determined only once
+        trip_pattern_stop_indices = self._gtfs_trip_patterns[trip_pattern_ids[0]]
+
+        candidate_indices = self._find_candidates(
+            self._gtfs_stop_coordinates[trip_pattern_stop_indices[0]],
+            self._gtfs_stop_coordinates[trip_pattern_stop_indices[-1]]
+        )
+
+        return [(trip_pattern_id, self._match_trip_pattern(trip_pattern_id, candidate_indices)) for trip_pattern_id in trip_pattern_ids]
+
+    def _find_candidates(self, start_point, end_point):
+        # find all linestring indices starting and ending within tolerance of start and end point
+        tolerance = self._maximum_matching_distance
+
+        geojson_start_coordinates = self._geojson_start_coordinates
+        geojson_end_coordinates = self._geojson_end_coordinates
+
+        # select only linestrings passing the start and end point of the trip pattern by their bounding box
+        start_tolerance_lon, start_tolerance_lat = _tolerance_degrees(start_point[1], tolerance)
+        end_tolerance_lon, end_tolerance_lat = _tolerance_degrees(end_point[1], tolerance)
+
+        start_indices = self._geojson_index.query(_tolerance_box(start_point, start_tolerance_lon, start_tolerance_lat))
+        end_indices = self._geojson_index.query(_tolerance_box(end_point, end_tolerance_lon, end_tolerance_lat))
+
+        candidate_indices = np.intersect1d(start_indices, end_indices)
+
+        # filter candidates whose first and last coordinate are not even close to start and end point
+        start_coordinates = geojson_start_coordinates[candidate_indices]
+        end_coordinates = geojson_end_coordinates[candidate_indices]
+
+        candidate_indices = candidate_indices[
+            (np.abs(start_coordinates[:, 0] - start_point[0]) < start_tolerance_lon) &
+            (np.abs(start_coordinates[:, 1] - start_point[1]) < start_tolerance_lat) &
+            (np.abs(end_coordinates[:, 0] - end_point[0]) < end_tolerance_lon) &
+            (np.abs(end_coordinates[:, 1] - end_point[1]) < end_tolerance_lat)
+        ]
+
+        # check for the start and end point of the trip matches the linestring start and end
+        start_distances = self._geod_distances(geojson_start_coordinates[candidate_indices], start_point)
+        end_distances = self._geod_distances(geojson_end_coordinates[candidate_indices], end_point)
+
+        return candidate_indices[(start_distances <= tolerance) & (end_distances <= tolerance)]
+
+    def _match_trip_pattern(self, trip_pattern_id, candidate_indices):
+        # find the best matching linestring index of a trip pattern among the candidates or None
+        tolerance = self._maximum_matching_distance
+
+        # bind linestring data to locals, they are accessed for every candidate
+        geojson_coordinates = self._geojson_coordinates
+        geojson_distances = self._geojson_distances
+        geojson_lengths = self._geojson_lengths
+
+        trip_pattern_coordinates = self._gtfs_stop_coordinates[self._gtfs_trip_patterns[trip_pattern_id]]
+
+        # meters per degree longitude at each stop, these are the same for all candidates
+        trip_pattern_scales = math.radians(1.0) * EARTH_RADIUS * np.cos(np.radians(trip_pattern_coordinates[:, 1]))
+
+        line_string_candidates = dict()
+        for index in candidate_indices.tolist():
+            line_string_coordinates = geojson_coordinates[index]
+
+            # check whether any point in trip pattern is not in this linestring
+            line_string_matched, trip_pattern_projections = _match_line_string(
+                line_string_coordinates,
+                geojson_distances[index],
+                trip_pattern_coordinates,
+                trip_pattern_scales,
+                tolerance
+            )
+
+            # if everything seems okay, use this as candidate
+            if line_string_matched:
+                line_string_candidates[index] = geojson_lengths[index]
+
+        if len(line_string_candidates) > 0:
+            # determine linestring index with the shortest possible length, this must be our linestring!
+            return min(line_string_candidates, key = line_string_candidates.get)
+        else:
+            return None
+
+    def _geod_distances(self, coordinates, point):
+        # geodesic distances in meters between an array of (lon, lat) coordinates and a single point
+        _, _, distances = self._geod.inv(
+            coordinates[:, 0],
+            coordinates[:, 1],
+            np.full(len(coordinates), point[0]),
+            np.full(len(coordinates), point[1])
+        )
+
+        return distances
 
     def _read_geojson_file(self, geojson_file):
-        geojson = json.load(geojson_file)
+        geojson = orjson.loads(geojson_file.read())
 
         for feature in geojson['features']:
             if feature['type'] == 'Feature' and feature['geometry']['type'] == 'LineString':
                 
-                coordinates = list()
-                for coordinate in feature['geometry']['coordinates']:
-                    coordinates.append(Point(coordinate[0], coordinate[1]))
+                # use only longitude and latitude, GeoJSON coordinates may contain an altitude as well
+                coordinates = np.array([(c[0], c[1]) for c in feature['geometry']['coordinates']], dtype=np.float64)
 
-                self._geojson_linestrings.append(LineString(coordinates))        
+                line_string = LineString(coordinates)
 
-    def _read_gtfs_index(self, working_directory):
+                self._geojson_linestrings.append(line_string)
+                self._geojson_coordinates.append(coordinates)
+                self._geojson_lengths.append(self._geod.geometry_length(line_string))
+                self._geojson_distances.append(np.concatenate(([0.0], np.cumsum(_haversine_distance(coordinates[:-1], coordinates[1:])))))
+
+    def _read_gtfs_index(self, gtfs_input):
         # read internal GTFS data index
         # read stop location data into index
-        stop_coordinate_index = dict()
-        with open(os.path.join(working_directory, 'stops.txt'), 'r') as txt_stops_file:
-            txt_stops_reader = csv.DictReader(txt_stops_file)
-            for txt_stops_row in txt_stops_reader:
-                stop_coordinate_index[txt_stops_row['stop_id']] = Point(
-                    float(txt_stops_row['stop_lon']),
-                    float(txt_stops_row['stop_lat'])
-                )
-
-        # read trip stop IDs into temporary index
-        trip_stop_id_lists = dict()
-        with open(os.path.join(working_directory, 'stop_times.txt'), 'r') as txt_stop_times_file:
-            txt_stop_times_reader = csv.DictReader(txt_stop_times_file)
-            for txt_stop_times_row in txt_stop_times_reader:
-                trip_id = txt_stop_times_row['trip_id']
-
-                if not trip_id in trip_stop_id_lists:
-                    trip_stop_id_lists[trip_id] = list()
-
-                trip_stop_id_lists[trip_id].append(txt_stop_times_row['stop_id'])
+        with _open_gtfs_file(gtfs_input, 'stops.txt') as txt_stops_file:
+            txt_stops = pandas.read_csv(
+                txt_stops_file,
+                usecols=['stop_id', 'stop_lon', 'stop_lat'],
+                dtype=str,
+                keep_default_na=False
+            )
+
+        self._gtfs_stop_indices = {stop_id: i for i, stop_id in enumerate(txt_stops['stop_id'])}
+        self._gtfs_stop_coordinates = np.column_stack([
+            txt_stops['stop_lon'].to_numpy(dtype=np.float64),
+            txt_stops['stop_lat'].to_numpy(dtype=np.float64)
+        ])
+
+        # read trip stop IDs into temporary index, keep the order of stop times within each trip
+        with _open_gtfs_file(gtfs_input, 'stop_times.txt') as txt_stop_times_file:
+            txt_stop_times = pandas.read_csv(
+                txt_stop_times_file,
+                usecols=['trip_id', 'stop_id'],
+                dtype=str,
+                keep_default_na=False
+            )
+
+        trip_stop_id_lists = txt_stop_times.groupby('trip_id', sort=False)['stop_id'].apply(list)
 
         # transform stop IDs to trip_patterns and coordinates
         for trip_id, stop_ids in trip_stop_id_lists.items():
-            trip_pattern_id = '#'.join(stop_ids)
+            trip_pattern_id = tuple(stop_ids)
 
             if not trip_pattern_id in self._gtfs_trip_patterns:
-                self._gtfs_trip_patterns[trip_pattern_id] = list()
-                for stop_id in stop_ids:
-                    self._gtfs_trip_patterns[trip_pattern_id].append(stop_coordinate_index[stop_id])
+                self._gtfs_trip_patterns[trip_pattern_id] = np.fromiter(
+                    (self._gtfs_stop_indices[stop_id] for stop_id in stop_ids),
+                    dtype=np.int32,
+                    count=len(stop_ids)
+                )
 
             if not trip_pattern_id in self._gtfs_trip_patterns_trip_ids:
                 self._gtfs_trip_patterns_trip_ids[trip_pattern_id] = list()
@@ -164,86 +368,83 @@ class GeojsonMatcher:
             self._gtfs_trip_patterns_trip_ids[trip_pattern_id].append(trip_id)
 
         # free up some memory ...
-        del stop_coordinate_index
         del trip_stop_id_lists
 
-    def _write_gtfs_data(self, working_directory, gtfs_output):
-        # remove old shapes.txt and write new shape data
-        if os.path.exists(os.path.join(working_directory, 'shapes.txt')):
-            os.remove(os.path.join(working_directory, 'shapes.txt'))
-        
-        with open(os.path.join(working_directory, 'shapes.txt'), 'w', newline='', encoding='utf-8') as txt_shapes:
-            txt_shapes_writer = csv.DictWriter(txt_shapes, fieldnames=['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence', 'shape_dist_traveled'])
-            txt_shapes_writer.writeheader()
-
-            for _, shape_data in self._gtfs_shapes.items():
-                txt_shapes_writer.writerows(shape_data)
+    def _write_gtfs_data(self, gtfs_input, gtfs_output):
+        # generate new shape data
+        shapes_columns = ['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence', 'shape_dist_traveled']
+        if len(self._gtfs_shapes) > 0:
+            txt_shapes = pandas.concat(self._gtfs_shapes.values(), ignore_index=True)
+        else:
+            txt_shapes = pandas.DataFrame(columns=shapes_columns)
 
         # load existing trips.txt into memory ...
-        trips_data = list()
-
-        with open(os.path.join(working_directory, 'trips.txt'), 'r', encoding='utf-8') as txt_trips:
-            txt_trips_reader = csv.DictReader(txt_trips)
-            trips_data = list(txt_trips_reader)
-
-        # remove old trips.txt and write adapted trip data
-        os.remove(os.path.join(working_directory, 'trips.txt'))
-        with open(os.path.join(working_directory, 'trips.txt'), 'w', newline='', encoding='utf-8') as txt_trips:
-            txt_trips_headers = list(trips_data[0].keys())
-            if 'shape_id' not in txt_trips_headers:
-                txt_trips_headers.append('shape_id')
-            
-            txt_trips_writer = csv.DictWriter(txt_trips, fieldnames=txt_trips_headers)
-            txt_trips_writer.writeheader()
-
-            for trip_record in trips_data:
-                if trip_record['trip_id'] in self._gtfs_trips_shape_ids:
-                    trip_record['shape_id'] = self._gtfs_trips_shape_ids[trip_record['trip_id']]
-                else:
-                    trip_record['shape_id'] = ''
-
-                txt_trips_writer.writerow(trip_record)
-
-        # if output should be a ZIP archive, compress everything
+        with _open_gtfs_file(gtfs_input, 'trips.txt') as txt_trips_file:
+            txt_trips = pandas.read_csv(
+                txt_trips_file,
+                dtype=str,
+                keep_default_na=False,
+                encoding='utf-8'
+            )
+
+        # assign shape IDs, trips without matching shape get an empty shape ID
+        txt_trips['shape_id'] = txt_trips['trip_id'].map(self._gtfs_trips_shape_ids).fillna('')
+
+        output_data = {
+            'shapes.txt': txt_shapes[shapes_columns],
+            'trips.txt': txt_trips
+        }
+
+        # copy all other files unchanged and write adapted data, ZIP archives are written without extracting anything
         if gtfs_output.lower().endswith('.zip'):
-            with zipfile.ZipFile(gtfs_output, 'w', zipfile.ZIP_DEFLATED) as gtfs_output_archive:
-                for txt_file in os.listdir(working_directory):
-                    if txt_file.endswith('.txt'):
-                        gtfs_output_archive.write(
-                            os.path.join(working_directory, txt_file),
-                            txt_file
-                        )
-
-                        os.remove(os.path.join(working_directory, txt_file))
-    
-    def _create_shape(self, trip_pattern_id, line_string):
-        
-        shape_data = list()
+            # writing the output archive truncates it, so write a temporary archive if it is the input as well
+            gtfs_output_archive_filename = gtfs_output
+            if os.path.exists(gtfs_output) and os.path.samefile(gtfs_input, gtfs_output):
+                gtfs_output_archive_file, gtfs_output_archive_filename = tempfile.mkstemp(suffix='.zip', dir=os.path.dirname(os.path.abspath(gtfs_output)))
+                os.close(gtfs_output_archive_file)
+
+            try:
+                with zipfile.ZipFile(gtfs_output_archive_filename, 'w', zipfile.ZIP_DEFLATED) as gtfs_output_archive:
+                    for txt_filename in _list_gtfs_files(gtfs_input):
+                        if txt_filename not in output_data:
+                            with _open_gtfs_file(gtfs_input, txt_filename) as txt_input_file, gtfs_output_archive.open(txt_filename, 'w') as txt_output_file:
+                                shutil.copyfileobj(txt_input_file, txt_output_file)
+
+                    for txt_filename, txt_data in output_data.items():
+                        with gtfs_output_archive.open(txt_filename, 'w') as txt_output_file:
+                            txt_data.to_csv(txt_output_file, index=False, encoding='utf-8', lineterminator='\r\n')
+
+                if gtfs_output_archive_filename != gtfs_output:
+                    os.replace(gtfs_output_archive_filename, gtfs_output)
+            finally:
+                # remove the temporary archive if writing failed before it was moved
+                if gtfs_output_archive_filename != gtfs_output and os.path.exists(gtfs_output_archive_filename):
+                    os.remove(gtfs_output_archive_filename)
+        else:
+            os.makedirs(gtfs_output, exist_ok=True)
+
+            if gtfs_input.lower().endswith('.zip') or not os.path.samefile(gtfs_input, gtfs_output):
+                for txt_filename in _list_gtfs_files(gtfs_input):
+                    if txt_filename not in output_data:
+                        with _open_gtfs_file(gtfs_input, txt_filename) as txt_input_file, open(os.path.join(gtfs_output, txt_filename), 'wb') as txt_output_file:
+                            shutil.copyfileobj(txt_input_file, txt_output_file)
+
+            for txt_filename, txt_data in output_data.items():
+                txt_data.to_csv(os.path.join(gtfs_output, txt_filename), index=False, encoding='utf-8', lineterminator='\r\n')
+
+    def _create_shape(self, trip_pattern_id, line_string_coordinates):
 
         shape_id = f"de:vpe:shape:{len(self._gtfs_shapes.keys())}"
-        shape_dist_traveled = 0.0
-        for i in range(len(line_string.coords) - 1):
-            shape_pt = line_string.coords[i]
-            next_shape_pt = line_string.coords[i + 1]
-
-            shape_data.append({
-                'shape_id': shape_id,
-                'shape_pt_lat': shape_pt[1],
-                'shape_pt_lon': shape_pt[0],
-                'shape_pt_sequence': i + 1,
-                'shape_dist_traveled': shape_dist_traveled
-            })
-
-            shape_dist_traveled = shape_dist_traveled + (self._geod.geometry_length(LineString([shape_pt, next_shape_pt])) / 1000.0)
-        
-        # finally add last shape point
-        last_shape_pt = line_string.coords[-1]
 
-        shape_data.append({
+        # calculate all segment lengths at once and accumulate them in kilometers
+        segment_lengths = self._geod.line_lengths(line_string_coordinates[:, 0], line_string_coordinates[:, 1])
+        shape_dist_traveled = np.concatenate(([0.0], np.cumsum(segment_lengths) / 1000.0))
+
+        shape_data = pandas.DataFrame({
             'shape_id': shape_id,
-            'shape_pt_lat': last_shape_pt[1],
-            'shape_pt_lon': last_shape_pt[0],
-            'shape_pt_sequence': len(shape_data) + 1,
+            'shape_pt_lat': line_string_coordinates[:, 1],
+            'shape_pt_lon': line_string_coordinates[:, 0],
+            'shape_pt_sequence': np.arange(1, len(line_string_coordinates) + 1),
             'shape_dist_traveled': shape_dist_traveled
         })
 